@@ -1,17 +1,16 @@
 #! /usr/bin/env python3
 
 import re
-from urllib.parse import urlparse
-import os
+import math
+import json
+import hashlib
 import logging
 import trio
-import asks
-from tenacity import retry, stop_after_attempt, after_log
+import httpx
 from pathlib import Path
 from datetime import datetime
-from bs4 import BeautifulSoup
-from peewee import IntegrityError
-from model import Map, Country, db, DB_FILE
+from lxml import etree
+from model import Map, Country, db
 
 logFormatter = logging.Formatter("%(asctime)s [%(levelname)-5.5s]  %(message)s")
 rootLogger = logging.getLogger()
@@ -28,124 +27,185 @@ rootLogger.addHandler(consoleHandler)
 DOWNLOAD_DIR = datetime.now().strftime("%d_%m_%y")
 Path(DOWNLOAD_DIR).mkdir(exist_ok=True)
 
-asks.init('trio')
 MAX_CONN = 100
-session = asks.Session(connections=MAX_CONN)
-headers = {'User-Agent': "Mozilla/5.0 (X11; Linux x86_64; rv:68.0) Gecko/20100101 Firefox/68.0"}
+WRITE_BATCH = 32
+COUNTRIES_CACHE = "countries.json"
 
+_RE_DATE = re.compile(r"(\d{8})|(\d\d-\d\d-\d{4})|(\d\d-\d\d-\d\d)")
+_RE_OPTION = re.compile(r'<option value="([^"]+)">([^<]+)</option>')
+limiter = trio.CapacityLimiter(MAX_CONN)
+headers = {'User-Agent': "Mozilla/5.0 (X11; Linux x86_64; rv:68.0) Gecko/20100101 Firefox/68.0"}
 
-async def setup_db():
-    r = await get_request("https://www.diplomatie.gouv.fr/fr/conseils-aux-voyageurs/conseils-par-pays-destination/")
-    soup = BeautifulSoup(r.text, 'lxml')
 
-    db.connect()
+async def setup_db(client):
     db.create_tables([Map, Country])
-    for country in soup.select('div.clearfix select#recherche_pays option'):
-        if country.text == "Sélectionnez un pays/destination":
+    try:
+        with open(COUNTRIES_CACHE) as f:
+            countries = json.load(f)
+    except (OSError, ValueError):
+        countries = []
+    if not countries:
+        r = await get_request(client, "https://www.diplomatie.gouv.fr/fr/conseils-aux-voyageurs/conseils-par-pays-destination/")
+        for option in _RE_OPTION.finditer(r.text):
+            value, name = option.group(1), option.group(2)
+            if name == "Sélectionnez un pays/destination":
+                continue
+            countries.append((name, value.split("/")[-2], value))
+        if not countries:
+            raise RuntimeError("No country found on the landing page")
+        with open(COUNTRIES_CACHE, 'w') as f:
+            json.dump(countries, f)
+    rows = [{'country_name': name, 'country_id': country_id, 'url': value}
+            for name, country_id, value in countries]
+    with db.atomic():
+        Country.insert_many(rows).execute()
+
+
+def find_image(events):
+    # dl.spip_documents covers most pages; a.spip_in.mediabox (Afghanistan) and
+    # figure.spip_documents (Afrique du Sud) are variants.
+    for _, el in events:
+        cls = el.get('class') or ""
+        if el.tag in ('dl', 'figure') and 'spip_documents' in cls:
+            img = el.find('.//img')
+            if img is None:
+                continue
+            url = img.get('src')
+        elif el.tag == 'a' and 'spip_in' in cls and 'mediabox' in cls:
+            url = el.get('href')
+        else:
             continue
-        Country.create(country_name=country.text, country_id=country["value"].split("/")[-2], url=country["value"])
-
-
-def find_image(soup):
-    # Most of URLs
-    select = soup.select('dl.spip_documents')
-    url = None
-    if select:
-        url = select[0].img["src"]
-    # Afghanistan
-    select = soup.select('a.spip_in.mediabox')
-    if select:
-        url = select[0]["href"]
-    # Afrique du Sud
-    select = soup.select('figure.spip_documents')
-    if select:
-        url = select[0].img["src"]
-    # remove extra "?""
-    if not url:
-        return
-    url = urlparse(url)
-    return url.netloc + url.path
-
-
-@retry(stop=stop_after_attempt(3), sleep=trio.sleep, after=after_log(rootLogger, logging.DEBUG))
-async def get_request(url, stream=False):
-    return await session.get(url, headers=headers, stream=stream)
-
-
-async def download_map(m):
+        if url:
+            # strip the scheme and any extra "?"
+            _, sep, rest = url.partition("://")
+            if not sep:
+                rest = url
+            return rest.split("?", 1)[0]
+
+
+async def get_request(client, url, stream=False):
+    for attempt in range(3):
+        try:
+            if stream:
+                return await client.send(client.build_request("GET", url), stream=True)
+            return await client.get(url)
+        except Exception as e:
+            if attempt == 2:
+                raise
+            logging.debug(f"Retrying {url} after: {e}")
+            await trio.sleep(2 ** attempt)
+
+
+async def download_map(client, country_id, url):
     DATE_FMT = '%Y%m%d'
-    country = m.country_id
-    m.date = guess_date(m)
-    m.path = DOWNLOAD_DIR + "/" + country + "_" + m.date.strftime(DATE_FMT) + ".jpg"
-    logging.info(f"Downloading map for {country} to {m.path}")
-    r = await get_request("https://www.diplomatie.gouv.fr/" + m.url, stream=True)
-    if r.status_code == 200:
-        async with await trio.open_file(m.path, 'wb') as f:
-            async for bytechunk in r.body:
-                await f.write(bytechunk)
-
-
-def guess_date(m):
-    country = m.country_id
-    filename = os.path.basename(urlparse(m.url).path)
-    date = re.findall(r".*(\d\d\d\d\d\d\d\d).*", filename)
-    if date:
-        if int(date[0][0:4]) < 2013:
-            # more likely %d%m%Y than %Y%m%d
-            date = datetime.strptime(date[0], '%d%m%Y')
-        else:
-            date = datetime.strptime(date[0], '%Y%m%d')
-        return date
-    date = re.findall(r".*(\d\d-\d\d-\d\d\d\d).*", filename)
-    if date:
-        date = datetime.strptime(date[0], '%d-%m-%Y')
-        return date
-    date = re.findall(r".*(\d\d-\d\d-\d\d).*", filename)
-    if date:
-        date = datetime.strptime(date[0], '%d-%m-%y')
-        return date
+    date = guess_date(country_id, url)
+    path = DOWNLOAD_DIR + "/" + country_id + "_" + date.strftime(DATE_FMT) + ".jpg"
+    logging.info(f"Downloading map for {country_id} to {path}")
+    r = await get_request(client, "https://www.diplomatie.gouv.fr/" + url)
+    r.raise_for_status()
+    return path, date, hashlib.md5(r.content).hexdigest(), r.content
+
+
+def guess_date(country, url):
+    filename = url.rsplit("/", 1)[-1].split("?", 1)[0]
+    m_date = _RE_DATE.search(filename)
+    if m_date:
+        if m_date.group(1):
+            s = m_date.group(1)
+            if int(s[0:4]) < 2013:
+                # more likely %d%m%Y than %Y%m%d
+                return datetime(int(s[4:8]), int(s[2:4]), int(s[0:2]))
+            return datetime(int(s[0:4]), int(s[4:6]), int(s[6:8]))
+        if m_date.group(2):
+            day, month, year = m_date.group(2).split("-")
+            return datetime(int(year), int(month), int(day))
+        day, month, year = m_date.group(3).split("-")
+        # same century pivot as strptime's %y
+        year = int(year)
+        return datetime(year + (2000 if year < 69 else 1900), int(month), int(day))
     logging.warning(f"Can't find date for {country} (filename {filename}), using today's date.")
     date = datetime.now()
     return date
 
 
-async def process_country(country):
-    logging.debug(f"Processing country {country.country_name}")
-    r = await get_request("https://www.diplomatie.gouv.fr/fr/conseils-aux-voyageurs/conseils-par-pays-destination/" + country.country_id)
-    soup = BeautifulSoup(r.text, 'lxml')
-    url = find_image(soup)
-    if not url:
-        logging.info(f"Can't find map URL for country {country.country_name}")
-        return
-    if Map.select().where((Map.country == country) & (Map.url == url)).exists():
-        logging.info(f"No new map for country {country.country_name}")
-        return
-    try:
-        m = Map.create(country=country, url=url)
-    except IntegrityError:
-        other_country = Map.select().where((Map.url == url)).first().country.country_name
-        logging.warning(f"{country.country_name} map already exists ({other_country})")
-        return
-
-    if m.url:
+async def process_country(client, country_id, country_name, known_maps, known_urls, send_channel):
+    async with limiter:
+        logging.debug(f"Processing country {country_name}")
+        r = await get_request(client, "https://www.diplomatie.gouv.fr/fr/conseils-aux-voyageurs/conseils-par-pays-destination/" + country_id, stream=True)
+        parser = etree.HTMLPullParser(events=('end',), collect_ids=False, huge_tree=False)
+        url = None
+        try:
+            async for bytechunk in r.aiter_bytes():
+                parser.feed(bytechunk)
+                url = find_image(parser.read_events())
+                if url:
+                    break
+        finally:
+            await r.aclose()
+        if not url:
+            logging.info(f"Can't find map URL for country {country_name}")
+            return
+        if (country_id, url) in known_maps:
+            logging.info(f"No new map for country {country_name}")
+            return
+        if url in known_urls:
+            logging.warning(f"{country_name} map already exists")
+            return
+        # claim the url before the first await so concurrent tasks can't race on it
+        known_urls.add(url)
         try:
-            await download_map(m)
-            m.save()
+            path, date, md5, body = await download_map(client, country_id, url)
         except Exception as e:
-            logging.error(f"Could not download map for {country.country_name} : {e}")
-    else:
-        logging.error(f"Can't find map for {country.country_name}")
+            logging.error(f"Could not download map for {country_name} : {e}")
+            return
+        row = {'country': country_id, 'url': url, 'path': path, 'date': date, 'md5': md5}
+        await send_channel.send((row, body))
+
+
+async def map_writer(receive_channel):
+    saved = 0
+    batch = []
+    async with receive_channel:
+        async for row, body in receive_channel:
+            await trio.to_thread.run_sync(Path(row['path']).write_bytes, body)
+            batch.append(row)
+            if len(batch) >= WRITE_BATCH:
+                save_maps(batch)
+                saved += len(batch)
+                batch = []
+    if batch:
+        save_maps(batch)
+        saved += len(batch)
+    if saved:
+        logging.info(f"Saved {saved} new maps")
+
+
+def save_maps(batch):
+    with db.atomic():
+        Map.insert_many(batch).on_conflict_ignore().execute()
 
 
 async def main():
 
-    if not os.path.isfile(DB_FILE):
-        await setup_db()
+    db.connect(reuse_if_open=True)
+
+    limits = httpx.Limits(max_connections=MAX_CONN, max_keepalive_connections=MAX_CONN)
+    async with httpx.AsyncClient(http2=True, headers=headers, limits=limits, follow_redirects=True) as client:
+        if not Country.table_exists() or not Country.select().exists():
+            await setup_db(client)
+
+        countries = list(Country.select(Country.country_id, Country.country_name).tuples())
+        logging.info(f"Processing {len(countries)} countries")
 
-    logging.info(f"Processing {Country.select().count()} countries")
+        known_maps = set(Map.select(Map.country, Map.url).tuples())
+        known_urls = {known_url for _, known_url in known_maps}
 
-    async with trio.open_nursery() as nursery:
-        for country in Country.select():
-            nursery.start_soon(process_country, country)
+        send_channel, receive_channel = trio.open_memory_channel(math.inf)
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(map_writer, receive_channel)
+            async with trio.open_nursery() as workers:
+                for country_id, country_name in countries:
+                    workers.start_soon(process_country, client, country_id, country_name, known_maps, known_urls, send_channel)
+            await send_channel.aclose()
 
 trio.run(main)
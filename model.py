@@ -1,7 +1,12 @@
 from peewee import Model, SqliteDatabase, CharField, ForeignKeyField, DateTimeField, IntegrityError, AutoField
 
 DB_FILE = 'maps.db'
-db = SqliteDatabase(DB_FILE)
+db = SqliteDatabase(DB_FILE, pragmas={
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -64000,
+    'temp_store': 'memory',
+})
 
 
 class BaseModel(Model):